@@ -1,10 +1,47 @@
+import ast
+import functools
+
 import modal
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
 from typing import Optional
 
 
 app = modal.App()
 
+
+def _eval_config_value(node):
+    """Evaluate a config value: literals, plus arithmetic on literals
+    (the configs write things like `gradient_accumulation_steps = 5 * 8`)."""
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        expr = ast.Expression(body=node)
+        allowed = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.operator, ast.unaryop)
+        if all(isinstance(n, allowed) for n in ast.walk(expr)):
+            return eval(compile(ast.fix_missing_locations(expr), '<config>', 'eval'), {'__builtins__': {}})
+        raise
+
+
+@functools.lru_cache(maxsize=None)
+def parse_config_file(config_content):
+    """Extract top-level literal assignments from a config file's source.
+
+    Safer and cheaper than exec()-ing the file: only `name = <literal>`
+    statements are honored, so imports, function defs and computed values
+    never leak into the config namespace, and the parse is cached on the
+    file content.
+    """
+    config_values = {}
+    for node in ast.parse(config_content).body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name)
+                and not node.targets[0].id.startswith('_')):
+            try:
+                config_values[node.targets[0].id] = _eval_config_value(node.value)
+            except ValueError:
+                print(f"ignoring non-literal config value for {node.targets[0].id}")
+    return config_values
+
 # Create volumes for profiling traces and model outputs
 traces = modal.Volume.from_name("nanogpt-traces", create_if_missing=True)
 checkpoints = modal.Volume.from_name("nanogpt-checkpoints", create_if_missing=True)
@@ -42,18 +79,21 @@ def train(config_file=None, enable_profiling=False):
 
     import os
     import time
-    import math
     import pickle
+    from concurrent.futures import ThreadPoolExecutor
     from contextlib import nullcontext
 
     import numpy as np
     import torch
     from torch.nn.parallel import DistributedDataParallel as DDP
     from torch.distributed import init_process_group, destroy_process_group
+    from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 
     from model import GPTConfig, GPT
 
-    @dataclass
+    # frozen + slots: the config is read-only after load, and slotted attribute
+    # reads are faster than the per-instance dict lookups of a plain dataclass
+    @dataclass(slots=True, frozen=True)
     class TrainingConfig:
         # I/O
         out_dir: str = '/checkpoints/out'
@@ -78,7 +118,8 @@ def train(config_file=None, enable_profiling=False):
         n_embd: int = 768
         dropout: float = 0.0
         bias: bool = False
-        # adamw optimizer
+        # adamw optimizer (the fused CUDA implementation is expected on the
+        # A100; configure_optimizers selects it and train() verifies it took)
         learning_rate: float = 6e-4
         max_iters: int = 600000
         weight_decay: float = 1e-1
@@ -95,24 +136,19 @@ def train(config_file=None, enable_profiling=False):
         # system
         device: str = 'cuda'
         dtype: str = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16'
+        # 'float32' keeps fp32 master weights; 'bfloat16' casts the parameters
+        # themselves, halving weight bandwidth (pair with compile fullgraph)
+        param_dtype: str = 'float32'
         compile: bool = True
 
         @classmethod
         def from_file(cls, config_file: str) -> 'TrainingConfig':
-            """Load config from a Python file."""
-            config_namespace = {}
+            """Load config from a Python file (top-level literal assignments only)."""
             with open(config_file) as f:
                 config_content = f.read()
 
-            # Execute the config file in an isolated namespace
-            exec(config_content, {}, config_namespace)
-
-            # Filter out private variables and functions
-            config_values = {k: v for k, v in config_namespace.items()
-                           if not k.startswith('_') and not callable(v)}
-
             # Create config instance with overrides
-            return cls(**config_values)
+            return cls(**parse_config_file(config_content))
 
     # Load configuration
     if config_file:
@@ -127,43 +163,16 @@ def train(config_file=None, enable_profiling=False):
     if not config.out_dir.startswith(CHECKPOINT_DIR):
         # Extract the final directory name from the original out_dir
         out_dir_name = os.path.basename(config.out_dir.rstrip('/'))
-        config.out_dir = os.path.join(CHECKPOINT_DIR, out_dir_name)
-        print(f"Adjusted out_dir to use checkpoint volume: {config.out_dir}")
-
-    # Extract config values for easier access
-    out_dir = config.out_dir
-    eval_interval = config.eval_interval
-    log_interval = config.log_interval
-    eval_iters = config.eval_iters
-    eval_only = config.eval_only
-    always_save_checkpoint = config.always_save_checkpoint
-    init_from = config.init_from
-    wandb_log = config.wandb_log
-    wandb_project = config.wandb_project
-    wandb_run_name = config.wandb_run_name
-    dataset = config.dataset
+        config = replace(config, out_dir=os.path.join(CHECKPOINT_DIR, out_dir_name))
+        print(f"Adjusted output dir to use checkpoint volume: {config.out_dir}")
+
+    # the config is referenced directly below (slotted attribute reads are
+    # cheap); locals remain only for the values train() itself adjusts and for
+    # the per-batch sampler closures
     gradient_accumulation_steps = config.gradient_accumulation_steps
     batch_size = config.batch_size
     block_size = config.block_size
-    n_layer = config.n_layer
-    n_head = config.n_head
-    n_embd = config.n_embd
-    dropout = config.dropout
-    bias = config.bias
-    learning_rate = config.learning_rate
-    max_iters = config.max_iters
-    weight_decay = config.weight_decay
-    beta1 = config.beta1
-    beta2 = config.beta2
-    grad_clip = config.grad_clip
-    decay_lr = config.decay_lr
-    warmup_iters = config.warmup_iters
-    lr_decay_iters = config.lr_decay_iters
-    min_lr = config.min_lr
-    backend = config.backend
     device = config.device
-    dtype = config.dtype
-    compile = config.compile
 
     # Convert config to dict for logging
     config_dict = asdict(config)
@@ -172,7 +181,14 @@ def train(config_file=None, enable_profiling=False):
     # various inits, derived attributes, I/O setup
     ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
     if ddp:
-        init_process_group(backend=backend)
+        # NCCL tuning for a single A100 node: tree allreduce with the Simple
+        # protocol is lowest latency at our 50 MB bucket size, and P2P traffic
+        # should stay on NVLink. setdefault so launcher overrides still win.
+        os.environ.setdefault('NCCL_ALGO', 'Tree')
+        os.environ.setdefault('NCCL_PROTO', 'Simple')
+        os.environ.setdefault('NCCL_NVLS_ENABLE', '1')
+        os.environ.setdefault('NCCL_P2P_LEVEL', 'NVL')
+        init_process_group(backend=config.backend)
         ddp_rank = int(os.environ['RANK'])
         ddp_local_rank = int(os.environ['LOCAL_RANK'])
         ddp_world_size = int(os.environ['WORLD_SIZE'])
@@ -193,36 +209,137 @@ def train(config_file=None, enable_profiling=False):
     print(f"tokens per iteration will be: {tokens_per_iter:,}")
 
     if master_process:
-        os.makedirs(out_dir, exist_ok=True)
+        os.makedirs(config.out_dir, exist_ok=True)
     torch.manual_seed(1337 + seed_offset)
     torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
     torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    # the tf32 flags above only cover explicit fp32 matmuls; this routes the
+    # residual fp32 ops (layernorm reductions, loss) through tf32 tensor cores too
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.benchmark = True # shapes are fixed, autotune once
+    # bind F.scaled_dot_product_attention to the flash kernel for bf16 on the
+    # A100 (fused qk^T/softmax/v with O(T) memory instead of the T x T scores
+    # matrix), keep the mem-efficient kernel as fallback, and rule out the
+    # slow math path so an unexpected fallback fails loudly instead
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(True)
+    torch.backends.cuda.enable_math_sdp(False)
     device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
     # note: float16 data type will automatically use a GradScaler
-    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[config.dtype]
     ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
     # poor man's data loader
-    print(f"Using dataset: {dataset}")
-    data_dir = os.path.join('data', dataset)
+    print(f"Using dataset: {config.dataset}")
+    data_dir = os.path.join('data', config.dataset)
     print(f"Data directory: {data_dir}")
+    # cache of open memmaps, keyed by split. We used to recreate np.memmap every
+    # batch to avoid a memory leak, as per
+    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
+    # but reopening the file every call is pure overhead on the hot path, so we
+    # open once and only reopen if the file grew/shrank underneath us (which is
+    # what the leak workaround was really guarding against)
+    _mmaps = {}
+    # a window covers block_size + 1 tokens so x and y are views of one gather
+    _window = np.arange(block_size + 1, dtype=np.int64)[None, :]
+    # batch indices are drawn in bulk from a PCG64 generator (much faster per
+    # draw than the legacy MT19937 and fully vectorized) and consumed row by
+    # row, so the per-batch RNG cost amortizes to almost nothing
+    batch_rng = np.random.default_rng(1337 + seed_offset)
+    idx_refill = 1024 # batches of indices generated per refill
+    _idx_pools = {}
+    def next_batch_indices(split, n_positions):
+        pool = _idx_pools.get(split)
+        if pool is None or pool['cursor'] == idx_refill or pool['n'] != n_positions:
+            pool = {'ix': batch_rng.integers(0, n_positions, size=(idx_refill, batch_size), dtype=np.int64),
+                    'cursor': 0, 'n': n_positions}
+            _idx_pools[split] = pool
+        ix = pool['ix'][pool['cursor']]
+        pool['cursor'] += 1
+        return ix
+
+    def sample_batch(split):
+        # draw a batch on the CPU, pinned so it can be copied to GPU asynchronously
+        bin_path = os.path.join(data_dir, 'train.bin' if split == 'train' else 'val.bin')
+        file_size = os.path.getsize(bin_path)
+        data = _mmaps.get(split)
+        if data is None or data.size * data.itemsize != file_size:
+            data = np.memmap(bin_path, dtype=np.uint16, mode='r')
+            _mmaps[split] = data
+        ix = next_batch_indices(split, len(data) - block_size - 1)
+        # vectorized gather: one fancy-index read and one uint16 -> int64 cast
+        # for the whole batch, instead of 2*batch_size slice+astype copies
+        window = data[ix[:, None] + _window].astype(np.int64)
+        x = torch.from_numpy(np.ascontiguousarray(window[:, :-1]))
+        y = torch.from_numpy(np.ascontiguousarray(window[:, 1:]))
+        if device_type == 'cuda':
+            x, y = x.pin_memory(), y.pin_memory()
+        return x, y
+
     def get_batch(split):
-        # We recreate np.memmap every batch to avoid a memory leak, as per
-        # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-        if split == 'train':
-            data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-        else:
-            data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+        x, y = sample_batch(split)
         if device_type == 'cuda':
-            # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-            x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
         else:
             x, y = x.to(device), y.to(device)
         return x, y
 
+    class GPTIterable(IterableDataset):
+        """Endless stream of (x, y) batches for one split, sampled with the
+        same vectorized gather as sample_batch but inside DataLoader worker
+        processes, so the memmap reads and uint16 -> int64 casts run outside
+        the main process (and its GIL)."""
+        def __init__(self, split):
+            super().__init__()
+            self.split = split
+
+        def __iter__(self):
+            worker = get_worker_info()
+            worker_id = worker.id if worker is not None else 0
+            rng = np.random.default_rng([1337 + seed_offset, worker_id])
+            bin_path = os.path.join(data_dir, 'train.bin' if self.split == 'train' else 'val.bin')
+            data = np.memmap(bin_path, dtype=np.uint16, mode='r')
+            window = np.arange(block_size + 1, dtype=np.int64)[None, :]
+            while True:
+                ix = rng.integers(0, len(data) - block_size - 1, size=batch_size)
+                batch = data[ix[:, None] + window].astype(np.int64)
+                x = torch.from_numpy(np.ascontiguousarray(batch[:, :-1]))
+                y = torch.from_numpy(np.ascontiguousarray(batch[:, 1:]))
+                yield x, y
+
+    # batch_size=None since the dataset already yields whole batches; the
+    # DataLoader's pin-memory thread replaces the explicit pin in sample_batch,
+    # and persistent workers avoid re-forking once training is underway
+    train_loader = DataLoader(GPTIterable('train'), batch_size=None, num_workers=2,
+                              pin_memory=(device_type == 'cuda'), prefetch_factor=4,
+                              persistent_workers=True)
+
+    class CUDAPrefetcher:
+        """Stages the next batch on a side CUDA stream (apex-style) so the
+        host->device copy overlaps the compute of the current micro-step."""
+        def __init__(self, batches):
+            self.batches = batches
+            self.stream = torch.cuda.Stream()
+            self.next_x = None
+            self.next_y = None
+            self.preload()
+
+        def preload(self):
+            x, y = next(self.batches)
+            with torch.cuda.stream(self.stream):
+                self.next_x = x.to(device, non_blocking=True)
+                self.next_y = y.to(device, non_blocking=True)
+
+        def next(self):
+            torch.cuda.current_stream().wait_stream(self.stream)
+            x, y = self.next_x, self.next_y
+            # tell the allocator these tensors are in use on the default stream,
+            # otherwise their memory could be reused while the copy is consumed
+            x.record_stream(torch.cuda.current_stream())
+            y.record_stream(torch.cuda.current_stream())
+            self.preload()
+            return x, y
+
     # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
     iter_num = 0
     best_val_loss = 1e9
@@ -237,9 +354,9 @@ def train(config_file=None, enable_profiling=False):
         print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
 
     # model init
-    model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
-                      bias=bias, vocab_size=None, dropout=dropout) # start with model_args from command line
-    if init_from == 'scratch':
+    model_args = dict(n_layer=config.n_layer, n_head=config.n_head, n_embd=config.n_embd, block_size=block_size,
+                      bias=config.bias, vocab_size=None, dropout=config.dropout) # start with model_args from command line
+    if config.init_from == 'scratch':
         # init a new model from scratch
         print("Initializing a new model from scratch")
         # determine the vocab size we'll use for from-scratch training
@@ -248,10 +365,10 @@ def train(config_file=None, enable_profiling=False):
         model_args['vocab_size'] = meta_vocab_size if meta_vocab_size is not None else 50304
         gptconf = GPTConfig(**model_args)
         model = GPT(gptconf)
-    elif init_from == 'resume':
-        print(f"Resuming training from {out_dir}")
+    elif config.init_from == 'resume':
+        print(f"Resuming training from {config.out_dir}")
         # resume training from a checkpoint.
-        ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+        ckpt_path = os.path.join(config.out_dir, 'ckpt.pt')
         checkpoint = torch.load(ckpt_path, map_location=device)
         checkpoint_model_args = checkpoint['model_args']
         # force these config attributes to be equal otherwise we can't even resume training
@@ -271,11 +388,11 @@ def train(config_file=None, enable_profiling=False):
         model.load_state_dict(state_dict)
         iter_num = checkpoint['iter_num']
         best_val_loss = checkpoint['best_val_loss']
-    elif init_from.startswith('gpt2'):
-        print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
+    elif config.init_from.startswith('gpt2'):
+        print(f"Initializing from OpenAI GPT-2 weights: {config.init_from}")
         # initialize from OpenAI GPT-2 weights
-        override_args = dict(dropout=dropout)
-        model = GPT.from_pretrained(init_from, override_args)
+        override_args = dict(dropout=config.dropout)
+        model = GPT.from_pretrained(config.init_from, override_args)
         # read off the created config params, so we can store them into checkpoint correctly
         for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
             model_args[k] = getattr(model.config, k)
@@ -283,69 +400,161 @@ def train(config_file=None, enable_profiling=False):
     if block_size < model.config.block_size:
         model.crop_block_size(block_size)
         model_args['block_size'] = block_size # so that the checkpoint will have the right value
+    if config.param_dtype == 'bfloat16':
+        # weights-in-bf16 training: halves parameter (and optimizer state)
+        # bandwidth at the cost of fp32 master weights
+        model.to(torch.bfloat16)
     model.to(device)
 
-    # initialize a GradScaler. If enabled=False scaler is a no-op
-    scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
+    # only fp16 needs a GradScaler; bf16 has fp32 exponent range so on the A100
+    # we take the direct backward/step path with no scaler dispatch at all
+    use_grad_scaler = config.dtype == 'float16'
+    if use_grad_scaler:
+        scaler = torch.cuda.amp.GradScaler()
+        torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = True
 
     # optimizer
-    optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
-    if init_from == 'resume':
+    optimizer = model.configure_optimizers(config.weight_decay, config.learning_rate, (config.beta1, config.beta2), device_type)
+    # configure_optimizers picks the fused AdamW when available (a single CUDA
+    # kernel per param group for the update instead of a dispatch per tensor);
+    # verify that here and fall back to the multi-tensor foreach path if this
+    # build lacks fused support
+    assert isinstance(optimizer, torch.optim.AdamW)
+    if device_type == 'cuda' and not optimizer.defaults.get('fused', False):
+        print("fused AdamW unavailable, falling back to foreach=True")
+        for param_group in optimizer.param_groups:
+            param_group['foreach'] = True
+        optimizer.defaults['foreach'] = True
+    if config.init_from == 'resume':
         optimizer.load_state_dict(checkpoint['optimizer'])
     checkpoint = None # free up memory
 
     # compile the model
-    if compile:
+    if config.compile:
         print("compiling the model... (takes a ~minute)")
         unoptimized_model = model
-        model = torch.compile(model) # requires PyTorch 2.0
+        # batch and block size are fixed, so let Inductor specialize on the
+        # shapes (dynamic=False) and autotune tile configs for them; fullgraph
+        # guards against silent graph breaks falling back to eager
+        model = torch.compile(model, mode="max-autotune", fullgraph=True, dynamic=False) # requires PyTorch 2.0
+        # train() and eval() compile to different graphs (dropout path), so
+        # trigger both up front rather than paying a recompile on the first eval
+        warmup_X, warmup_Y = get_batch('train')
+        with ctx:
+            model(warmup_X, warmup_Y)
+        model.eval()
+        with torch.inference_mode(), ctx:
+            model(warmup_X, warmup_Y)
+        model.train()
+        warmup_X = warmup_Y = None
 
     # wrap model into DDP container
     if ddp:
-        model = DDP(model, device_ids=[ddp_local_rank])
+        # gradient_as_bucket_view makes .grad tensors views into the reducer's
+        # buckets instead of separate copies (saves ~model-size bytes of GPU
+        # memory), static_graph lets DDP skip the per-iter unused-parameter
+        # search since our graph never changes, and 50 MB buckets give better
+        # allreduce/backward overlap than the 25 MB default at this model size
+        model = DDP(model, device_ids=[ddp_local_rank],
+                    gradient_as_bucket_view=True, static_graph=True, bucket_cap_mb=50)
+
+    # the eval forward has a fixed batch shape, so for an uncompiled model we
+    # capture it once as a CUDA graph and replay it, which strips the
+    # Python-driven kernel launch overhead from the eval_iters * 2 forward
+    # passes per eval. Captured lazily on the first eval so the model (DDP
+    # wrap) is fully set up by then. When config.compile is set this is skipped:
+    # max-autotune already runs Inductor's own cudagraphs, and recording those
+    # launches inside an outer manual capture is unsupported (and the captured
+    # loss would alias the cudagraph-tree memory pool shared with train mode).
+    eval_graph = {}
+    def capture_eval_graph(X, Y):
+        state = {'x': torch.empty_like(X), 'y': torch.empty_like(Y)}
+        state['x'].copy_(X)
+        state['y'].copy_(Y)
+        # graph capture requires warmup on a side stream
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(3):
+                with ctx:
+                    model(state['x'], state['y'])
+        torch.cuda.current_stream().wait_stream(s)
+        state['graph'] = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(state['graph']):
+            with ctx:
+                _, state['loss'] = model(state['x'], state['y'])
+        return state
 
     # helps estimate an arbitrarily accurate loss over either split using many batches
-    @torch.no_grad()
+    @torch.inference_mode()
     def estimate_loss():
         out = {}
         model.eval()
         for split in ['train', 'val']:
-            losses = torch.zeros(eval_iters)
-            for k in range(eval_iters):
+            # accumulate on-device: a .item() per batch would be a full GPU
+            # sync each time, so we read back a single scalar per split instead
+            losses = torch.empty(config.eval_iters, device=device)
+            for k in range(config.eval_iters):
                 X, Y = get_batch(split)
-                with ctx:
-                    logits, loss = model(X, Y)
-                losses[k] = loss.item()
-            out[split] = losses.mean()
+                if device_type == 'cuda' and not config.compile:
+                    if not eval_graph:
+                        eval_graph.update(capture_eval_graph(X, Y))
+                    # refill the static inputs and replay the captured forward
+                    eval_graph['x'].copy_(X, non_blocking=True)
+                    eval_graph['y'].copy_(Y, non_blocking=True)
+                    eval_graph['graph'].replay()
+                    losses[k] = eval_graph['loss']
+                else:
+                    with ctx:
+                        logits, loss = model(X, Y)
+                    losses[k] = loss.detach()
+            out[split] = losses.float().mean().item()
         model.train()
         return out
 
-    # learning rate decay scheduler (cosine with warmup)
-    def get_lr(it):
+    # learning rate decay scheduler (cosine with warmup), precomputed for the
+    # whole run as a lookup table so the hot loop does a single list index
+    # instead of branches + math.cos + a param_groups walk every iteration
+    def build_lr_schedule():
+        it = np.arange(config.max_iters + 1)
         # 1) linear warmup for warmup_iters steps
-        if it < warmup_iters:
-            return learning_rate * (it + 1) / (warmup_iters + 1)
-        # 2) if it > lr_decay_iters, return min learning rate
-        if it > lr_decay_iters:
-            return min_lr
+        warmup = config.learning_rate * (it + 1) / (config.warmup_iters + 1)
         # 3) in between, use cosine decay down to min learning rate
-        decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters)
-        assert 0 <= decay_ratio <= 1
-        coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
-        return min_lr + coeff * (learning_rate - min_lr)
+        decay_ratio = np.clip((it - config.warmup_iters) / (config.lr_decay_iters - config.warmup_iters), 0.0, 1.0)
+        coeff = 0.5 * (1.0 + np.cos(np.pi * decay_ratio)) # coeff ranges 0..1
+        lr = np.where(it < config.warmup_iters, warmup, config.min_lr + coeff * (config.learning_rate - config.min_lr))
+        # 2) if it > lr_decay_iters, return min learning rate
+        lr = np.where(it > config.lr_decay_iters, config.min_lr, lr)
+        return lr.tolist()
+    lr_schedule = build_lr_schedule() if config.decay_lr else None
 
     # logging
-    if wandb_log and master_process:
+    if config.wandb_log and master_process:
         import wandb
-        wandb.init(project=wandb_project, name=wandb_run_name, config=config_dict)
+        wandb.init(project=config.wandb_project, name=config.wandb_run_name, config=config_dict)
 
     # training loop
-    X, Y = get_batch('train') # fetch the very first batch
+    train_iter = iter(train_loader) # spawns the persistent workers
+    def next_train_batch():
+        x, y = next(train_iter)
+        return x.to(device), y.to(device)
+    prefetcher = CUDAPrefetcher(train_iter) if device_type == 'cuda' else None
+    # fetch the very first batch
+    X, Y = prefetcher.next() if prefetcher is not None else next_train_batch()
     t0 = time.time()
     local_iter_num = 0 # number of iterations in the lifetime of this process
     raw_model = model.module if ddp else model # unwrap DDP container if needed
     running_mfu = -1.0
 
+    # async loss logging: instead of loss.item() (a full GPU sync every
+    # log_interval), copy the scalar loss into a pinned ring buffer with a
+    # non-blocking d2h copy and read it one iteration later, by which time the
+    # copy has long completed and the event sync is effectively free
+    loss_history = 16
+    if device_type == 'cuda':
+        loss_buf = torch.empty(loss_history, pin_memory=True)
+        loss_events = [torch.cuda.Event() for _ in range(loss_history)]
+
     # Setup profiling if enabled
     prof = None
     if enable_profiling:
@@ -362,18 +571,38 @@ def train(config_file=None, enable_profiling=False):
         )
         prof.start()
 
+    # checkpoint saves run on a single background thread so the training loop
+    # only blocks on staging the model tensors to the CPU, not on the seconds
+    # of pickling + volume commit for a ~500 MB checkpoint
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_future = None
+    # a volume commit is a network round-trip to durable storage, so only sync
+    # when val loss improved (plus a periodic safety commit); saves with a
+    # regressed loss still land on the fast local ckpt.pt
+    commit_every_evals = 10
+    evals_since_commit = 0
+    def save_checkpoint(checkpoint, commit):
+        torch.save(checkpoint, os.path.join(config.out_dir, 'ckpt.pt'),
+                   pickle_protocol=5, _use_new_zipfile_serialization=False)
+        if commit:
+            checkpoints.commit()
+
+    # cache the param groups: configure_optimizers builds exactly two
+    # (weight-decayed and non-decayed), so we can write both lr slots directly
+    param_groups = optimizer.param_groups
+    assert len(param_groups) == 2
+
     while True:
 
         # determine and set the learning rate for this iteration
-        lr = get_lr(iter_num) if decay_lr else learning_rate
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
+        lr = lr_schedule[min(iter_num, config.max_iters)] if config.decay_lr else config.learning_rate
+        param_groups[0]['lr'] = param_groups[1]['lr'] = lr
 
         # evaluate the loss on train/val sets and write checkpoints
-        if iter_num % eval_interval == 0 and master_process:
+        if iter_num % config.eval_interval == 0 and master_process:
             losses = estimate_loss()
             print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-            if wandb_log:
+            if config.wandb_log:
                 wandb.log({
                     "iter": iter_num,
                     "train/loss": losses['train'],
@@ -381,57 +610,98 @@ def train(config_file=None, enable_profiling=False):
                     "lr": lr,
                     "mfu": running_mfu*100, # convert to percentage
                 })
-            if losses['val'] < best_val_loss or always_save_checkpoint:
+            if losses['val'] < best_val_loss or config.always_save_checkpoint:
+                improved = losses['val'] < best_val_loss
                 best_val_loss = losses['val']
                 if iter_num > 0:
+                    # make sure the previous save fully flushed so two saves
+                    # never race on the same file
+                    if ckpt_future is not None:
+                        ckpt_future.result()
+                    # stage the model and optimizer tensors on the CPU, then
+                    # hand the slow pickle + commit off to the background
+                    # thread. The optimizer state must be snapshotted here too:
+                    # passing live CUDA tensors to the worker would let
+                    # torch.save copy them while optimizer.step() keeps
+                    # mutating them, tearing the saved state across iterations
+                    state_cpu = {k: v.detach().to('cpu', non_blocking=True)
+                                 for k, v in raw_model.state_dict().items()}
+                    opt_state_cpu = optimizer.state_dict()
+                    opt_state_cpu['state'] = {
+                        k: {n: v.to('cpu', non_blocking=True) if torch.is_tensor(v) else v
+                            for n, v in s.items()}
+                        for k, s in opt_state_cpu['state'].items()}
+                    if device_type == 'cuda':
+                        torch.cuda.synchronize()
                     checkpoint = {
-                        'model': raw_model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
+                        'model': state_cpu,
+                        'optimizer': opt_state_cpu,
                         'model_args': model_args,
                         'iter_num': iter_num,
                         'best_val_loss': best_val_loss,
                         'config': config_dict,
                     }
-                    print(f"saving checkpoint to {out_dir}")
-                    torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
-                    checkpoints.commit()
-        if iter_num == 0 and eval_only:
+                    print(f"saving checkpoint to {config.out_dir}")
+                    evals_since_commit += 1
+                    do_commit = improved or evals_since_commit >= commit_every_evals
+                    if do_commit:
+                        evals_since_commit = 0
+                    ckpt_future = ckpt_executor.submit(save_checkpoint, checkpoint, do_commit)
+        if iter_num == 0 and config.eval_only:
             break
 
         # forward backward update, with optional gradient accumulation to simulate larger batch size
         # and using the GradScaler if data type is float16
+        # free the gradients up front so the caching allocator can reuse their
+        # memory for activations during the forward pass
+        optimizer.zero_grad(set_to_none=True)
         for micro_step in range(gradient_accumulation_steps):
-            if ddp:
-                # in DDP training we only need to sync gradients at the last micro step.
-                # the official way to do this is with model.no_sync() context manager, but
-                # I really dislike that this bloats the code and forces us to repeat code
-                # looking at the source of that context manager, it just toggles this variable
-                model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-            with ctx:
+            # in DDP training we only need to sync gradients at the last micro step,
+            # via the official no_sync() context manager. With static_graph=True DDP
+            # then schedules a single fused allreduce at the accumulation boundary.
+            is_last_micro_step = micro_step == gradient_accumulation_steps - 1
+            sync_ctx = model.no_sync() if ddp and not is_last_micro_step else nullcontext()
+            with sync_ctx, ctx:
                 logits, loss = model(X, Y)
                 loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
             # immediately async prefetch next batch while model is doing the forward pass on the GPU
-            X, Y = get_batch('train')
+            X, Y = prefetcher.next() if prefetcher is not None else next_train_batch()
             # backward pass, with gradient scaling if training in fp16
-            scaler.scale(loss).backward()
-        # clip the gradient
-        if grad_clip != 0.0:
-            scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-        # step the optimizer and scaler if training in fp16
-        scaler.step(optimizer)
-        scaler.update()
-        # flush the gradients as soon as we can, no need for this memory anymore
-        optimizer.zero_grad(set_to_none=True)
+            if use_grad_scaler:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        # clip the gradient, then step the optimizer (and the scaler in fp16)
+        if use_grad_scaler:
+            if config.grad_clip != 0.0:
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_clip)
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            if config.grad_clip != 0.0:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_clip)
+            optimizer.step()
 
         # timing and logging
         t1 = time.time()
         dt = t1 - t0
         t0 = t1
-        if iter_num % log_interval == 0 and master_process:
-            # get loss as float. note: this is a CPU-GPU sync point
+        if device_type == 'cuda':
+            # stage this iteration's loss for later readback, off the sync path
+            slot = local_iter_num % loss_history
+            loss_buf[slot].copy_(loss.detach(), non_blocking=True)
+            loss_events[slot].record()
+        if iter_num % config.log_interval == 0 and master_process:
             # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
-            lossf = loss.item() * gradient_accumulation_steps
+            if device_type == 'cuda':
+                # read the previous iteration's loss (a one-iteration logging lag)
+                # so we never stall the GPU waiting on the value just produced
+                read = max(local_iter_num - 1, 0) % loss_history
+                loss_events[read].synchronize()
+                lossf = loss_buf[read].item() * gradient_accumulation_steps
+            else:
+                lossf = loss.item() * gradient_accumulation_steps
             if local_iter_num >= 5: # let the training loop settle a bit
                 mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
                 running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
@@ -445,7 +715,7 @@ def train(config_file=None, enable_profiling=False):
         local_iter_num += 1
 
         # termination conditions
-        if iter_num > max_iters:
+        if iter_num > config.max_iters:
             break
 
     # Stop profiler if enabled and save trace
@@ -453,6 +723,13 @@ def train(config_file=None, enable_profiling=False):
         prof.stop()
         print(f"Profiling traces saved to {TRACE_DIR}/nanogpt_profile")
 
+    # wait for any in-flight checkpoint save before tearing down, and flush
+    # any local saves whose per-eval volume sync was skipped
+    if ckpt_future is not None:
+        ckpt_future.result()
+        checkpoints.commit()
+    ckpt_executor.shutdown()
+
     if ddp:
         destroy_process_group()
 